@@ -29,14 +29,13 @@ class BatchNormClassificationHead(PredictionHead):
         self.build(model)
 
     def z_norm(self, inputs):
-        mean = inputs.mean(0, keepdim=True)
-        var = inputs.var(0, unbiased=False, keepdim=True)
+        # var_mean computes both statistics in one reduction pass
+        var, mean = torch.var_mean(inputs, dim=0, unbiased=False, keepdim=True)
         return (inputs - mean) / torch.sqrt(var + 1e-9)
 
     def forward(self, outputs, cls_output=None, attention_mask=None, return_dict=False, **kwargs):
         cls_output = cls_output if cls_output is not None else outputs[0][:, 0]
-        cls_ouput = self.z_norm(cls_output)
-        print('norming')
+        cls_output = self.z_norm(cls_output)
         logits = super().forward(cls_output)
         loss = None
         labels = kwargs.pop("labels", None)
@@ -1,37 +1,65 @@
 import run
 import copy
+import json
 import yaml
 import argparse
 import numpy as np
 import os
 import pandas as pd
+import joblib
 import sklearn
-from sklearn.ensemble import GradientBoostingRegressor
+from sklearn.ensemble import HistGradientBoostingRegressor
 from sklearn.model_selection import GridSearchCV
 from scipy.stats import pearsonr
 import matplotlib.pyplot as plt
 
 
 def create_dataset(config):
-    data = {}
-    for pair in config["test"]["pairs"]:
-        data[str(pair[0]) + '-' + str(pair[1])] = []
+    # store predictions as one dense (pairs, models, examples) float32 array plus a
+    # sidecar pair list instead of a pickled dict of Python lists
+    pairs = [str(pair[0]) + '-' + str(pair[1]) for pair in config["test"]["pairs"]]
+    data = None
     for i, path in enumerate(config['adapter_path']):
         single_config = copy.deepcopy(config)
         single_config['adapter_path'] = path
         scores, language_pairs = run.predict(single_config, save=False)
         for predictions, pair in zip(scores, language_pairs):
-            data[str(pair[0]) + '-' + str(pair[1])].append(predictions)
+            predictions = np.ravel(predictions).astype(np.float32)
+            if data is None:
+                data = np.empty((len(pairs), len(config['adapter_path']), len(predictions)), dtype=np.float32)
+            data[pairs.index(str(pair[0]) + '-' + str(pair[1])), i] = predictions
         print()
     np.save(os.path.join('data', 'ensemble_data_train.npy'), data)
+    with open(os.path.join('data', 'ensemble_data_train_pairs.json'), 'w') as f:
+        json.dump(pairs, f)
+
+
+def load_ensemble(path):
+    """Loads ensemble predictions as a dense (pairs, models, examples) array.
+
+    New files are memory-mapped directly; legacy pickled dicts are converted on the fly.
+    """
+    try:
+        arr = np.load(path, mmap_mode="r")
+        with open(os.path.splitext(path)[0] + "_pairs.json") as f:
+            pairs = json.load(f)
+        return arr, pairs
+    except ValueError:
+        data = np.load(path, allow_pickle=True).item()
+        pairs = list(data.keys())
+        # fill one preallocated buffer instead of stacking per pair and copying again
+        first = next(iter(data.values()))
+        arr = np.empty((len(pairs), len(first), np.ravel(first[0]).shape[0]), dtype=np.float32)
+        for p, predictions in enumerate(data.values()):
+            for m, prediction in enumerate(predictions):
+                arr[p, m] = np.ravel(prediction)
+        return arr, pairs
 
 
 def load_data(use_pair=True, use_train=False):
-    data_dev = np.load(os.path.join('data', 'ensemble_data2.npy'), allow_pickle=True).item()
-    data_test = np.load(os.path.join('data', 'ensemble_data_test2.npy'), allow_pickle=True).item()
-    data_train = np.load(os.path.join('data', 'ensemble_data_train.npy'), allow_pickle=True).item()
-    columns = ['pair', 'model1', 'model2', 'model3', 'model4', 'model5']
-    pairs = list(data_dev.keys())
+    data_dev, pairs = load_ensemble(os.path.join('data', 'ensemble_data2.npy'))
+    data_test, _ = load_ensemble(os.path.join('data', 'ensemble_data_test2.npy'))
+    data_train, _ = load_ensemble(os.path.join('data', 'ensemble_data_train.npy'))
     true_scores_dev = []
     true_scores_test = []
     true_scores_train = []
@@ -57,31 +85,20 @@ def load_data(use_pair=True, use_train=False):
     #plt.scatter([i for i in range(len(true_scores[:1000]))], true_scores[2000:3000])
     #print(pairs)
 
-    def process_dict(data_dict):
-        all_preds = []
-        all_pairs = []
-        for pair, predictions in data_dict.items():
-            onehot_pair = [int(pair == p) for p in pairs]
-            pair_class = [pairs.index(pair) for i in range(len(predictions[0]))]
-            all_pairs.append(pair_class)
-            #pair_class = pd.Series([pairs.index(pair) for i in range(len(predictions[0]))]) # TODO: Maybe norm to one?
-            #df['pair'] = df['pair'].append(pair_class)
-            per_pair_preds = []
-            for i in range(len(predictions)):
-                per_pair_preds.append(np.ravel(predictions[i]))
-                #df['model{}'.format(i + 1)] = df['model{}'.format(i + 1)].append(preds)
-            per_pair_preds = np.vstack(per_pair_preds)
-            all_preds.append(per_pair_preds)
-        all_pairs = np.concatenate(all_pairs)
-        all_preds = np.hstack(all_preds)
-        all_data = np.vstack((all_pairs, all_preds)).T if use_pair else all_preds.T
-        return all_data
+    def process_array(arr):
+        # (pairs, models, examples) -> (pairs*examples, models) with models as columns
+        n_pairs, n_models, n_examples = arr.shape
+        all_preds = np.asarray(arr).transpose(0, 2, 1).reshape(-1, n_models)
+        if not use_pair:
+            return all_preds
+        pair_class = np.repeat(np.arange(n_pairs), n_examples)
+        return np.concatenate((pair_class[:, None], all_preds), axis=1)
     #plt.scatter([i for i in range(len(true_scores[:1000]))], all_data[:, 1][2000:3000])
     #plt.show()
-    all_data_dev = process_dict(data_dev)
-    all_data_test = process_dict(data_test)
+    all_data_dev = process_array(data_dev)
+    all_data_test = process_array(data_test)
     if use_train:
-        all_data_train = process_dict(data_train)
+        all_data_train = process_array(data_train)
         all_data_dev = np.concatenate((all_data_train, all_data_dev))
         true_scores_dev = np.concatenate((true_scores_train, true_scores_dev))
 
@@ -91,22 +108,28 @@ def load_data(use_pair=True, use_train=False):
 def gradient_boosting():
     X_train, X_test, y_train, y_test = load_data(False, True)
 
+    # the histogram-based regressor bins features once and is orders of magnitude
+    # faster to fit than GradientBoostingRegressor at this dataset size
     params = {
-        'n_estimators': [50, 80, 100, 120],
-        'subsample': [0.1, 0.2, 0.5, 1],
+        'max_iter': [50, 80, 100, 120],
         'learning_rate': [0.01, 0.05, 0.1],
-        'criterion': ['friedman_mse', 'mse'],
         'max_depth': [2, 3],
-        'max_features': [3, 4, 5]
+        'max_leaf_nodes': [15, 31],
+        'l2_regularization': [0.0, 0.1]
     }
-    # {'criterion': 'mse', 'learning_rate': 0.05, 'max_depth': 2, 'n_estimators': 100, 'subsample': 0.1}
-    regressor = GradientBoostingRegressor()
-    #regressor.fit(X_train, y_train)
-    gs = GridSearchCV(regressor, params, cv=5, n_jobs=-1, verbose=1, scoring='neg_mean_squared_error')
-    gs.fit(X_train, y_train)
-    print('Best parameters: ')
-    print(gs.best_params_)
-    predictions = gs.predict(X_test)
+    model_path = os.path.join('data', 'gradient_boosting.joblib')
+    if os.path.isfile(model_path):
+        best = joblib.load(model_path)
+    else:
+        regressor = HistGradientBoostingRegressor()
+        gs = GridSearchCV(regressor, params, cv=5, n_jobs=-1, pre_dispatch="2*n_jobs", verbose=1,
+                          scoring='neg_mean_squared_error')
+        gs.fit(X_train, y_train)
+        print('Best parameters: ')
+        print(gs.best_params_)
+        best = gs.best_estimator_
+        joblib.dump(best, model_path, compress=3)
+    predictions = best.predict(X_test)
     paired_predictions = np.split(predictions, 7)
     paired_targets = np.split(y_test, 7)
     base_predictions = [X_test[:, i] for i in range(0, 5)]
@@ -174,7 +197,8 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("config")
     args = parser.parse_args()
-    config = yaml.load(open(args.config), Loader=yaml.FullLoader)
+    with open(args.config) as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
     #config = yaml.load(open('configs\\predict_config.yaml'), Loader=yaml.FullLoader)
     #gradient_boosting()
     #print('Stacking')
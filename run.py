@@ -1,7 +1,11 @@
 import argparse
 import collections
+import contextlib
+import hashlib
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from datetime import datetime
 from typing import Union, List, Optional
 
@@ -10,11 +14,12 @@ from torch.nn import Embedding
 import yaml
 from torch.utils.data import DataLoader, Sampler
 from transformers import TrainingArguments, Trainer, \
-    EvalPrediction, TrainerCallback, AutoConfig, AutoTokenizer, AutoModelWithHeads
+    EvalPrediction, TrainerCallback, AutoConfig, AutoTokenizer, AutoModelWithHeads, \
+    DataCollatorWithPadding
 import numpy as np
 from scipy.stats import pearsonr
 import transformers.adapters.composition as ac
-from datasets import load_dataset, Dataset, DatasetDict
+from datasets import load_dataset, Dataset, DatasetDict, Features, Sequence, Value
 import logging
 import random
 from transformers.adapters.configuration import AdapterConfig
@@ -31,14 +36,55 @@ logging.basicConfig(format='%(asctime)s - %(message)s',
 
 LANG_TO_OFFSET = {"si": 0, "km": 1}
 
+@lru_cache(maxsize=4)
+def get_tokenizer(name):
+    # test/predict call load_data once per pair; reloading the sentencepiece
+    # model each time costs seconds for no reason
+    return AutoTokenizer.from_pretrained(name)
+
+
+def dynamic_collator(config):
+    # padding each batch to its own maximum (in multiples of 8 for tensor cores)
+    # is only valid when no ac.Split composition can be active: Split slices the
+    # sequence at a fixed split_index, which needs the original padded to exactly
+    # max_seq_len. Returns None (= default collator) for the fixed-padding paths.
+    if (config.get("no_lang", False) and config.get("architecture", "base") == "base"
+            and not config.get("extend_embeddings", False)):
+        return DataCollatorWithPadding(get_tokenizer(config.get("model", "xlm-roberta-base")),
+                                       pad_to_multiple_of=8)
+    return None
+
+
+# the bf16 TrainingArguments flags only exist from transformers 4.13 on; the
+# adapter-transformers stack predates them, so only pass them where they exist
+# and fall back to fp16 elsewhere
+_supports_bf16 = "bf16" in TrainingArguments.__dataclass_fields__
+
+
+def full_eval_precision(config):
+    # eval has no optimizer state to protect, so run the whole forward in half
+    # precision where supported
+    args = {"fp16_full_eval": config.get("fp16_full_eval", False)}
+    if _supports_bf16:
+        args["bf16_full_eval"] = config.get("bf16_full_eval",
+                                            torch.cuda.is_available() and torch.cuda.is_bf16_supported())
+    return args
+
+
 def main(config):
     torch.manual_seed(config.get("seed", 400002021))
     np.random.seed(config.get("seed", 400002021))
     random.seed(config.get("seed", 400002021))
 
+    # TF32 accelerates the remaining FP32 matmuls on Ampere+ for free
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
     os.environ["WANDB_WATCH"] = "false"
     if config.get("wandb_project", ""):
         os.environ["WANDB_PROJECT"] = config["wandb_project"]
+    if config.get("precompute", False):
+        precompute_all(config)
     if config.get('predict', False):
         return predict(config)
     if config.get("do_train", True):
@@ -53,7 +99,8 @@ def train(config):
     output_dir = os.path.join(config["output_dir"], task_folder)
     os.makedirs(output_dir, exist_ok=True)
     logging.info(f"Saving results in {output_dir}")
-    yaml.dump(config, open(os.path.join(output_dir, "train_config.yaml"), "w"))
+    with open(os.path.join(output_dir, "train_config.yaml"), "w") as f:
+        yaml.dump(config, f)
 
     model_config = AutoConfig.from_pretrained(config.get("model", "xlm-roberta-base"), num_labels=1, hidden_dropout_prob=config.get("dropout", 0.1))
     model = AutoModelWithHeads.from_pretrained(config.get("model", "xlm-roberta-base"), config=model_config)
@@ -98,8 +145,22 @@ def train(config):
         model.train_adapter([task+"_original", task+"_translation", task+"_tri"])
     else:
         model.train_adapter([task])
+    if config["train"].get("bf16_frozen", False):
+        # train_adapter froze everything but the adapters and head; the frozen
+        # backbone needs no FP32 master weights, so storing it in bf16 halves its
+        # memory and keeps its GEMMs on tensor cores even outside autocast regions
+        for p in model.parameters():
+            if not p.requires_grad:
+                p.data = p.data.to(torch.bfloat16)
+    if config.get("torch_compile", True) and hasattr(torch, "compile"):
+        # inputs are padded to a fixed max_seq_len, so the graph is static and the
+        # fused kernels pay off; no-op on torch < 2.0
+        model = torch.compile(model, mode="reduce-overhead", fullgraph=False)
     dataset = load_data(train_config["pair"], task, config)
 
+    # bf16 matches the fp16 tensor-core speedup without GradScaler loss scaling,
+    # so no steps get skipped on overflow
+    use_bf16 = _supports_bf16 and train_config.get("bf16", torch.cuda.is_available() and torch.cuda.is_bf16_supported())
     training_args = TrainingArguments(
         learning_rate=train_config.get("learning_rate", 0.0001),
         num_train_epochs=train_config["epochs"],
@@ -110,15 +171,22 @@ def train(config):
         output_dir=output_dir,
         overwrite_output_dir=True,
         gradient_accumulation_steps=train_config.get("gradient_accumulation_steps", 1),
-        fp16=train_config.get("amp", True),
+        fp16=train_config.get("amp", True) and not use_bf16,
+        **({"bf16": train_config.get("amp", True) and use_bf16} if _supports_bf16 else {}),
         eval_steps=train_config.get("eval_steps", 250),
         evaluation_strategy="steps",
         load_best_model_at_end=True,
         metric_for_best_model="pearson",
-        save_total_limit=train_config.get("save_total_limit", None),
+        # the best adapters are saved manually after training, so keep only one
+        # rolling checkpoint for best-model tracking instead of serializing and
+        # accumulating one every eval
+        save_steps=train_config.get("save_steps", train_config.get("eval_steps", 250)),
+        save_total_limit=train_config.get("save_total_limit", 1),
         run_name=task_folder,
         report_to=config.get("report_to", "all"),
-        skip_memory_metrics=config.get("skip_memory_metrics", True)
+        skip_memory_metrics=config.get("skip_memory_metrics", True),
+        dataloader_num_workers=train_config.get("num_workers", 4),
+        dataloader_pin_memory=True
     )
 
     skip_layer = []  # [11] if config.get("madx2", False) else []
@@ -136,6 +204,7 @@ def train(config):
             train_dataset=dataset["train"],
             eval_dataset=dataset["dev"],
             compute_metrics=compute_pearson,
+            data_collator=dynamic_collator(config),
             do_save_adapters=True,
             do_save_full_model=False
         )
@@ -160,6 +229,7 @@ def train(config):
             train_dataset=dataset["train"],
             eval_dataset=dataset["dev"],
             compute_metrics=compute_pearson,
+            data_collator=dynamic_collator(config),
             do_save_adapters=True,
             do_save_full_model=False
         )
@@ -222,13 +292,17 @@ def predict_ensemble(config):
     output_dir = os.path.join(os.path.dirname(config['output_dir']), 'submissions')
     os.makedirs(output_dir, exist_ok=True)
     logging.info(f"Saving results in {output_dir}")
-    yaml.dump(config, open(os.path.join(output_dir, "test_config.yaml"), "w"))
+    with open(os.path.join(output_dir, "test_config.yaml"), "w") as f:
+        yaml.dump(config, f)
     scores = []
+    # load the union of pair languages up front; load_lang_adapter is idempotent,
+    # so pairs sharing a language reuse what is already on the model
+    for pair in config["test"]["pairs"]:
+        load_lang_adapter(model, pair[0], config)
+        load_lang_adapter(model, pair[1], config)
     for pair in config["test"]["pairs"]:
         lang1, lang2 = pair
         logging.info(f"Evaluation results for {task} {lang1}-{lang2}")
-        load_lang_adapter(model, lang1, config)
-        load_lang_adapter(model, lang2, config)
         dataset = load_data(pair, task, config)
 
         skip_layer = []  # [11] if config.get("madx2", False) else []
@@ -244,7 +318,11 @@ def predict_ensemble(config):
                                    per_device_eval_batch_size=config["test"]["batchsize"],
                                    run_name=task_folder,
                                    report_to=config.get("report_to", "all"),
-                                   skip_memory_metrics=config.get("skip_memory_metrics", True)),
+                                   skip_memory_metrics=config.get("skip_memory_metrics", True),
+                                   dataloader_num_workers=config.get("num_workers", 4),
+                                   dataloader_pin_memory=True,
+                                   **full_eval_precision(config)),
+            data_collator=dynamic_collator(config),
             adapter_setup=setup, weird_fix=True)
         predictions = test_trainer.predict(dataset["test"], metric_key_prefix="test")
         z_scores = predictions.predictions
@@ -276,13 +354,17 @@ def predict(config, task_folder=None, save=True):
     os.makedirs(output_dir, exist_ok=True)
     logging.info(f"Saving results in {output_dir}")
     if save:
-        yaml.dump(config, open(os.path.join(output_dir, "prediction_config.yaml"), "w"))
+        with open(os.path.join(output_dir, "prediction_config.yaml"), "w") as f:
+            yaml.dump(config, f)
     scores = []
+    # load the union of pair languages up front; load_lang_adapter is idempotent,
+    # so pairs sharing a language reuse what is already on the model
+    for pair in config["test"]["pairs"]:
+        load_lang_adapter(model, pair[0], config)
+        load_lang_adapter(model, pair[1], config)
     for pair in config["test"]["pairs"]:
         lang1, lang2 = pair
         logging.info(f"Evaluation results for {task} {lang1}-{lang2}")
-        load_lang_adapter(model, lang1, config)
-        load_lang_adapter(model, lang2, config)
         dataset = load_data(pair, task, config)
         skip_layer = []
         if config.get("architecture", "base") == "split":
@@ -297,14 +379,20 @@ def predict(config, task_folder=None, save=True):
         else:
             setup = [ac.Split(lang1, lang2, split_index=config.get("max_seq_len", 50)), *task_adapter]
         model.set_active_adapters(setup, skip_layers=skip_layer)
-        test_trainer = Trainer(
+        # CustomTrainer only for its _prepare_inputs: int32_ids datasets need the
+        # on-device widening here too
+        test_trainer = CustomTrainer(
             model=model,
             args=TrainingArguments(output_dir=output_dir,
                                    remove_unused_columns=False,
                                    per_device_eval_batch_size=config["test"]["batchsize"],
                                    run_name=task_folder,
                                    report_to=config.get("report_to", "all"),
-                                   skip_memory_metrics=config.get("skip_memory_metrics", True))
+                                   skip_memory_metrics=config.get("skip_memory_metrics", True),
+                                   dataloader_num_workers=config.get("num_workers", 4),
+                                   dataloader_pin_memory=True,
+                                   **full_eval_precision(config)),
+            data_collator=dynamic_collator(config)
         )
         predictions = test_trainer.predict(dataset["test"], metric_key_prefix="test")
         z_scores = predictions.predictions
@@ -362,13 +450,42 @@ def test(config, model=None, task_folder=None):
     output_dir = os.path.join(config["output_dir"], task_folder)
     os.makedirs(output_dir, exist_ok=True)
     logging.info(f"Saving results in {output_dir}")
-    yaml.dump(config, open(os.path.join(output_dir, "test_config.yaml"), "w"))
+    with open(os.path.join(output_dir, "test_config.yaml"), "w") as f:
+        yaml.dump(config, f)
     results = {"dev": [], "test": [], "task": task}
+    # one Trainer reused for every pair and split; re-instantiating it per
+    # evaluation re-wrapped the model and re-initialized AMP and callbacks each time
+    eval_args = TrainingArguments(output_dir=output_dir,
+                                  remove_unused_columns=False,
+                                  per_device_eval_batch_size=config["test"]["batchsize"],
+                                  run_name=task_folder,
+                                  report_to=config.get("report_to", "all"),
+                                  skip_memory_metrics=config.get("skip_memory_metrics", True),
+                                  dataloader_num_workers=config.get("num_workers", 4),
+                                  dataloader_pin_memory=True,
+                                  **full_eval_precision(config))
+    if (config.get("torch_compile", True) and hasattr(torch, "compile")
+            and not isinstance(model, torch._dynamo.OptimizedModule)):
+        # compiled once above the pair loop so adapter switches reuse the cached
+        # graphs; train() hands over an already compiled model, so don't wrap it
+        # twice; no-op on torch < 2.0
+        model = torch.compile(model, mode="reduce-overhead", fullgraph=False)
+    # CustomTrainer only for its _prepare_inputs: int32_ids datasets need the
+    # on-device widening here too
+    eval_trainer = CustomTrainer(
+        model=model,
+        args=eval_args,
+        compute_metrics=compute_pearson,
+        data_collator=dynamic_collator(config)
+    )
+    # load the union of pair languages up front; load_lang_adapter is idempotent,
+    # so pairs sharing a language reuse what is already on the model
+    for pair in config["test"]["pairs"]:
+        load_lang_adapter(model, pair[0], config)
+        load_lang_adapter(model, pair[1], config)
     for pair in config["test"]["pairs"]:
         lang1, lang2 = pair
         logging.info(f"Evaluation results for {task} {lang1}-{lang2}")
-        load_lang_adapter(model, lang1, config)
-        load_lang_adapter(model, lang2, config)
         dataset = load_data(pair, task, config)
 
         skip_layer = [] # [11] if config.get("madx2", False) else []
@@ -384,39 +501,27 @@ def test(config, model=None, task_folder=None):
         else:
             setup = [ac.Split(lang1, lang2, split_index=config.get("max_seq_len", 50)), *task_adapter]
         model.set_active_adapters(setup, skip_layers=skip_layer)
-        dev_trainer = Trainer(
-            model=model,
-            args=TrainingArguments(output_dir=output_dir,
-                                   remove_unused_columns=False,
-                                   per_device_eval_batch_size=config["test"]["batchsize"],
-                                   run_name=task_folder,
-                                   report_to=config.get("report_to", "all"),
-                                   skip_memory_metrics=config.get("skip_memory_metrics", True)),
-            eval_dataset=dataset["dev"],
-            compute_metrics=compute_pearson
-        )
-        dev_evaluation = dev_trainer.evaluate(metric_key_prefix="dev")
+        dev_evaluation = eval_trainer.evaluate(eval_dataset=dataset["dev"], metric_key_prefix="dev")
         dev_evaluation["pair"] = f"{lang1}_{lang2}"
         results["dev"].append(dev_evaluation)
-        test_trainer = Trainer(
-            model=model,
-            args=TrainingArguments(output_dir=output_dir,
-                                   remove_unused_columns=False,
-                                   per_device_eval_batch_size=config["test"]["batchsize"],
-                                   run_name=task_folder,
-                                   report_to=config.get("report_to", "all"),
-                                   skip_memory_metrics=config.get("skip_memory_metrics", True)),
-            eval_dataset=dataset["test"],
-            compute_metrics=compute_pearson
-        )
-        test_evaluation = test_trainer.evaluate(metric_key_prefix="test")
+        test_evaluation = eval_trainer.evaluate(eval_dataset=dataset["test"], metric_key_prefix="test")
         test_evaluation["pair"] = f"{lang1}_{lang2}"
         results["test"].append(test_evaluation)
     logging.info(results)
-    json.dump(results, open(os.path.join(output_dir, f"evaluation_{task}.json"), "w"), indent=2)
+    with open(os.path.join(output_dir, f"evaluation_{task}.json"), "w") as f:
+        json.dump(results, f, indent=2)
 
 
 def load_lang_adapter(model, language, config):
+    # test/predict call this once per pair, so overlapping languages used to be
+    # re-downloaded and their embeddings re-extended every time; remember what this
+    # model instance already has and bail out early
+    loaded = getattr(model, "_loaded_lang_adapters", None)
+    if loaded is None:
+        loaded = model._loaded_lang_adapters = set()
+    if language in loaded:
+        return
+    loaded.add(language)
     if not config.get("no_lang", False):
         download_langs = set(["ro", "si", "km", "ps", "ne"])
         if language in download_langs:
@@ -439,19 +544,35 @@ def load_lang_adapter(model, language, config):
         current_emb_len = model.bert.embeddings.word_embeddings.num_embeddings
         config["token_offset"][LANG_TO_OFFSET[language]] = current_emb_len
         logging.info(f"Extend embedding {language}, {added_embeddings.shape[0]}")
-        new_embedding = Embedding(current_emb_len+added_embeddings.shape[0], added_embeddings.shape[1], padding_idx=0)
-        new_embedding.weight.data = torch.cat([model.bert.embeddings.word_embeddings.weight.data, added_embeddings])
+        # grow the weight in place on the embedding's own device: Embedding() would
+        # randomly initialize a full new matrix that we immediately overwrite, and
+        # torch.cat would allocate yet another copy
+        old_weight = model.bert.embeddings.word_embeddings.weight.data
+        new_weight = torch.empty(current_emb_len + added_embeddings.shape[0], added_embeddings.shape[1],
+                                 device=old_weight.device, dtype=old_weight.dtype)
+        new_weight[:current_emb_len].copy_(old_weight)
+        new_weight[current_emb_len:].copy_(added_embeddings.to(device=old_weight.device, dtype=old_weight.dtype))
+        new_embedding = Embedding(new_weight.shape[0], new_weight.shape[1], padding_idx=0, _weight=new_weight)
         model.bert.embeddings.word_embeddings = new_embedding
 
 
 def load_data(lang_pairs, task, config):
     if isinstance(lang_pairs[0], str):
         lang_pairs = [lang_pairs]
-    tokenizer = AutoTokenizer.from_pretrained(config.get("model", "xlm-roberta-base"))
+    tokenizer = get_tokenizer(config.get("model", "xlm-roberta-base"))
+
+    def read_f(f, dt):
+        # one batched read instead of readlines + per-line Python casts; the context
+        # manager also closes the handle, which the old one-liner leaked. Float
+        # files come back as a float32 array so the scores never get re-boxed
+        # into Python floats on the way to Arrow
+        with open(f, encoding="utf-8") as fh:
+            data = fh.read().splitlines()
+        if dt is float:
+            return np.asarray(data, dtype=np.float32)
+        return data
 
     if config.get('predict', False) and not config.get('debug', False) and not config.get('boosting', False):
-        def read_f(f, dt):
-            return [dt(l.strip()) for l in open(f, encoding="utf-8").readlines()]
         test_mt, test_src = [], []
         for(lang1, lang2) in lang_pairs:
             if [lang1, lang2] in [['en', 'cs'], ['en', 'ja'], ['km', 'en'], ['ps', 'en']]:
@@ -474,8 +595,6 @@ def load_data(lang_pairs, task, config):
         dataset = dataset.rename_column("z_mean", "label")
 
     if config.get('debug', False):
-        def read_f(f, dt):
-            return [dt(l.strip()) for l in open(f, encoding="utf-8").readlines()]
         train_hter, dev_hter, test_hter, train_src, dev_src, test_src, train_mt, dev_mt, test_mt = [], [], [], [], [], [], [], [], []
         for (lang1, lang2) in lang_pairs:
 
@@ -492,8 +611,6 @@ def load_data(lang_pairs, task, config):
         #dataset = DatasetDict({"test": test})
 
     if config.get('boosting', False):
-        def read_f(f, dt):
-            return [dt(l.strip()) for l in open(f, encoding="utf-8").readlines()]
         train_hter, dev_hter, test_hter, train_src, dev_src, test_src, train_mt, dev_mt, test_mt = [], [], [], [], [], [], [], [], []
         for (lang1, lang2) in lang_pairs:
             da_scores = pd.read_csv(f"data/data/direct-assessments/dev/{lang1}-{lang2}-dev/dev.{lang1}{lang2}.df.short.tsv",
@@ -510,33 +627,61 @@ def load_data(lang_pairs, task, config):
 
 
     if task == "qe_hter":
-        def read_f(f, dt):
-            return [dt(l.strip()) for l in open(f, encoding="utf-8").readlines()]
-        train_hter, dev_hter, test_hter, train_src, dev_src, test_src, train_mt, dev_mt, test_mt = [], [], [], [], [], [], [], [], []
-        for (lang1, lang2) in lang_pairs:
-            train_hter.extend(read_f(f"data/data/post-editing/train/{lang1}-{lang2}-train/train.hter", float))
-            dev_hter.extend(read_f(f"data/data/post-editing/dev/{lang1}-{lang2}-dev/dev.hter", float))
-            test_hter.extend(read_f(f"data/data/post-editing/test/{lang1}-{lang2}-test20/test20.hter", float))
-            train_src.extend(read_f(f"data/data/post-editing/train/{lang1}-{lang2}-train/train.src", str))
-            dev_src.extend(read_f(f"data/data/post-editing/dev/{lang1}-{lang2}-dev/dev.src", str))
-            test_src.extend(read_f(f"data/data/post-editing/test/{lang1}-{lang2}-test20/test20.src", str))
-            train_mt.extend(read_f(f"data/data/post-editing/train/{lang1}-{lang2}-train/train.mt", str))
-            dev_mt.extend(read_f(f"data/data/post-editing/dev/{lang1}-{lang2}-dev/dev.mt", str))
-            test_mt.extend(read_f(f"data/data/post-editing/test/{lang1}-{lang2}-test20/test20.mt", str))
-        train = Dataset.from_dict({"original": train_src, "translation": train_mt, "label": train_hter}, split="train")
-        dev = Dataset.from_dict({"original": dev_src, "translation": dev_mt, "label": dev_hter}, split="dev")
-        test = Dataset.from_dict({"original": test_src, "translation": test_mt, "label": test_hter}, split="test")
-        dataset = DatasetDict({"train": train, "dev": dev, "test": test})
+        split_prefixes = {
+            "train": "data/data/post-editing/train/{lang1}-{lang2}-train/train",
+            "dev": "data/data/post-editing/dev/{lang1}-{lang2}-dev/dev",
+            "test": "data/data/post-editing/test/{lang1}-{lang2}-test20/test20",
+        }
+
+        def build_split(split):
+            hter_parts, src, mt = [], [], []
+            for (lang1, lang2) in lang_pairs:
+                prefix = split_prefixes[split].format(lang1=lang1, lang2=lang2)
+                tasks = [(prefix + ".hter", float), (prefix + ".src", str), (prefix + ".mt", str)]
+                # the GIL is released during the reads, so one thread per file
+                # overlaps the disk waits instead of paying them back to back
+                with ThreadPoolExecutor(max_workers=len(tasks)) as ex:
+                    results = list(ex.map(lambda ft: read_f(*ft), tasks))
+                hter_parts.append(results[0])
+                src.extend(results[1])
+                mt.extend(results[2])
+            # the float32 array is zero-copied by Arrow; a list of Python floats
+            # would be ingested element by element with dtype inference
+            return Dataset.from_dict({"original": src, "translation": mt,
+                                      "label": np.concatenate(hter_parts)}, split=split)
+
+        # building one split at a time lets its Python lists be freed before the
+        # next split is read, so peak memory holds one split twice (list + Arrow
+        # table) instead of all three
+        dataset = DatasetDict({split: build_split(split) for split in ("train", "dev", "test")})
+
+    # build the prompt prefixes and the alternative si/km tokenizers once here;
+    # they used to be recreated inside the encode function for every batch
+    prompt_prefixes = None
+    if "prompt" in config:
+        prompt_orig, prompt_transl = config["prompt"]
+        prompt_prefixes = (f"{prompt_orig}: ", f"{prompt_transl}: ")
+    alt_tokenizers = {}
+    if config.get("extend_embeddings", False):
+        for lang1, _ in lang_pairs:
+            if lang1 in ["si", "km"] and lang1 not in alt_tokenizers:
+                alt_tokenizers[lang1] = get_tokenizer(f"data/{lang1}-tokenizer")
+
+    # The manual merge below exists to pad the original to exactly max_seq_len so the
+    # ac.Split compositions find the translation at split_index. Without language adapters
+    # and with the plain architecture no Split is ever active, so the fast tokenizer can
+    # build the sentence pair natively in one Rust pass instead of the Python merge loops.
+    pair_encoding = (config.get("no_lang", False) and config.get("architecture", "base") == "base"
+                     and not config.get("extend_embeddings", False))
 
     def encode(is_train, lang_pairs):
         def _encode(all_data):
             """Encodes a batch of input data using the model tokenizer."""
             original = all_data["original"]
             translation = all_data["translation"]
-            if "prompt" in config:
-                prompt_orig, prompt_transl = config["prompt"]
-                original = [f"{prompt_orig}: {o}" for o in original]
-                translation = [f"{prompt_transl}: {t}" for t in translation]
+            if prompt_prefixes:
+                original = [prompt_prefixes[0] + o for o in original]
+                translation = [prompt_prefixes[1] + t for t in translation]
 
             if config.get('only_translations', False):
                 sen2 = tokenizer(translation, max_length=config.get("max_seq_len", 50), truncation=True,
@@ -548,45 +693,100 @@ def load_data(lang_pairs, task, config):
                                  padding="max_length")
                 return sen1
 
+            if pair_encoding:
+                # sequences stay ragged here; dynamic_collator pads each batch to
+                # its own maximum instead of the full 2 * max_seq_len
+                return tokenizer(original, translation, max_length=2 * config.get("max_seq_len", 50),
+                                 truncation="only_second")
+
             sen1 = tokenizer(original, max_length=config.get("max_seq_len", 50), truncation=True, padding="max_length")
             if config.get("extend_embeddings", False):
                 factor = 7000 if is_train else 1000
                 for i, (lang1, lang2) in enumerate(lang_pairs):
                     if lang1 in ["si", "km"]:
-                        alt_tokenizer = AutoTokenizer.from_pretrained(f"data/{lang1}-tokenizer")
-                        sen1_alt = alt_tokenizer(original[i*factor:i*factor+factor], max_length=config.get("max_seq_len", 50), truncation=True, padding="max_length")
+                        sen1_alt = alt_tokenizers[lang1](original[i*factor:i*factor+factor], max_length=config.get("max_seq_len", 50), truncation=True, padding="max_length")
                         offset = config["token_offset"][LANG_TO_OFFSET[lang1]]
-                        sen1["input_ids"][i*factor:i*factor+factor] = [[i+offset for i in sen] for sen in sen1_alt["input_ids"]]
+                        # one vectorized add over the padded (factor, max_seq_len) block
+                        # instead of a Python loop over every token
+                        remapped = np.asarray(sen1_alt["input_ids"], dtype=np.int64) + offset
+                        sen1["input_ids"][i*factor:i*factor+factor] = remapped.tolist()
 
             sen2 = tokenizer(translation, max_length=config.get("max_seq_len", 50), truncation=True, padding="max_length")
 
+            # both sides are padded to max_seq_len, so the rows are rectangular and
+            # the merge is a single numpy concatenate per field instead of a Python
+            # append/extend pass over every row
+            ids1 = np.asarray(sen1["input_ids"])
+            ids2 = np.asarray(sen2["input_ids"])
+            mask1 = np.asarray(sen1["attention_mask"])
+            mask2 = np.asarray(sen2["attention_mask"])
             if "xlm" in config.get("model", "xlm-roberta-base"):
-                for i1, i2 in zip(sen1["input_ids"], sen2["input_ids"]):
-                    i1.append(2)
-                    i1.extend(i2[1:])
-
-                for a1, a2 in zip(sen1["attention_mask"], sen2["attention_mask"]):
-                    a1.extend(a2)
+                sep = np.full((ids1.shape[0], 1), 2, dtype=ids1.dtype)
+                sen1["input_ids"] = np.concatenate([ids1, sep, ids2[:, 1:]], axis=1).tolist()
+                sen1["attention_mask"] = np.concatenate([mask1, mask2], axis=1).tolist()
             else:
-                for i1, i2 in zip(sen1["input_ids"], sen2["input_ids"]):
-                    i1.extend(i2[1:])
-
-                for a1, a2 in zip(sen1["attention_mask"], sen2["attention_mask"]):
-                    a1.extend(a2[1:])
-
-                for t1, t2 in zip(sen1["token_type_ids"], sen2["token_type_ids"]):
-                    t1.extend([1]*(len(t2)-1))
+                sen1["input_ids"] = np.concatenate([ids1, ids2[:, 1:]], axis=1).tolist()
+                sen1["attention_mask"] = np.concatenate([mask1, mask2[:, 1:]], axis=1).tolist()
+                types1 = np.asarray(sen1["token_type_ids"])
+                types2 = np.ones((types1.shape[0], ids2.shape[1] - 1), dtype=types1.dtype)
+                sen1["token_type_ids"] = np.concatenate([types1, types2], axis=1).tolist()
 
             return sen1
         return _encode
-    # Encode the input data
+    # Encode the input data. Cache the encoded splits on disk, keyed by everything that
+    # influences the encoding, so repeated runs skip the Python tokenization loop.
+    encode_fingerprint = hashlib.md5(repr((
+        config.get("model", "xlm-roberta-base"), config.get("max_seq_len", 50), config.get("prompt", None),
+        config.get("only_translations", False), config.get("only_source", False),
+        config.get("extend_embeddings", False), config.get('predict', False), config.get('debug', False),
+        config.get('boosting', False), task, lang_pairs,
+        # pair_encoding produces ragged native pairs, the Split paths mid-padded
+        # ones, so the row layout depends on these two flags as well
+        config.get("no_lang", False), config.get("architecture", "base"),
+        # the extend_embeddings remap bakes the resolved offsets into input_ids,
+        # and since the adapter loads are hoisted they depend on the full pairs
+        # list of the run, not just the pair being encoded
+        config.get("token_offset", None)
+    )).encode()).hexdigest()
+    os.makedirs("cache", exist_ok=True)
+
+    def cache_file(split):
+        return os.path.join("cache", f"{split}_{encode_fingerprint}.arrow")
+
+    # the fast tokenizer releases the GIL, so sharding the one-time encoding pass
+    # over processes scales with cores; the extend_embeddings path addresses batches
+    # by absolute position (i*factor) and must stay single-process
+    map_workers = None
+    if not config.get("extend_embeddings", False):
+        map_workers = min(len(lang_pairs) * 2, os.cpu_count())
+
     if config.get('predict', False):
         dataset["test"] = dataset["test"].map(encode(False, lang_pairs), batched=True,
-                                              batch_size=1000 * len(lang_pairs))
+                                              batch_size=1000 * len(lang_pairs),
+                                              num_proc=map_workers, writer_batch_size=10000,
+                                              load_from_cache_file=True, cache_file_name=cache_file("test"))
     else:
-        dataset["train"] = dataset["train"].map(encode(True, lang_pairs), batched=True, batch_size=7000*len(lang_pairs))
-        dataset["test"] = dataset["test"].map(encode(False, lang_pairs), batched=True, batch_size=1000*len(lang_pairs))
-        dataset["dev"] = dataset["dev"].map(encode(False, lang_pairs), batched=True, batch_size=1000*len(lang_pairs))
+        dataset["train"] = dataset["train"].map(encode(True, lang_pairs), batched=True, batch_size=7000*len(lang_pairs),
+                                                num_proc=map_workers, writer_batch_size=10000,
+                                                load_from_cache_file=True, cache_file_name=cache_file("train"))
+        dataset["test"] = dataset["test"].map(encode(False, lang_pairs), batched=True, batch_size=1000*len(lang_pairs),
+                                              num_proc=map_workers, writer_batch_size=10000,
+                                              load_from_cache_file=True, cache_file_name=cache_file("test"))
+        dataset["dev"] = dataset["dev"].map(encode(False, lang_pairs), batched=True, batch_size=1000*len(lang_pairs),
+                                            num_proc=map_workers, writer_batch_size=10000,
+                                            load_from_cache_file=True, cache_file_name=cache_file("dev"))
+    if config.get("int32_ids", False):
+        # the XLM-R vocab fits comfortably in int32 and the mask in int8, so this
+        # halves (ids) or eighths (mask) the bytes stored and moved per batch.
+        # index columns stay at int32 (not int8) because embedding lookups reject
+        # narrower dtypes; the trainers upcast to int64 on-device for older torch
+        for split in dataset:
+            features = dict(dataset[split].features)
+            features["input_ids"] = Sequence(Value("int32"))
+            features["attention_mask"] = Sequence(Value("int8"))
+            if "token_type_ids" in features:
+                features["token_type_ids"] = Sequence(Value("int32"))
+            dataset[split] = dataset[split].cast(Features(features))
     # Transform to pytorch tensors and only output the required columns
     if "xlm" in config.get("model", "xlm-roberta-base"):
         if config.get('predict', False):
@@ -601,14 +801,47 @@ def load_data(lang_pairs, task, config):
     return dataset
 
 
+def precompute_all(config):
+    """Warms the on-disk encode caches for every test pair.
+
+    load_data keys its Arrow caches by an encoding fingerprint, so after one pass
+    here the per-pair calls inside the test/predict loops reduce to cache reads.
+    """
+    task = config["task"]
+    for pair in config["test"]["pairs"]:
+        load_data(pair, task, config)
+
+
 def compute_pearson(p: EvalPrediction):
-    if len(p.predictions) == 1000: #hard coded
-        return {"pearson": pearsonr(p.predictions.reshape(-1), p.label_ids)[0]}
+    # float32 is plenty for a correlation on model outputs and halves the temporaries
+    predictions = np.asarray(p.predictions, dtype=np.float32).reshape(-1)
+    label_ids = np.asarray(p.label_ids, dtype=np.float32).reshape(-1)
+    if len(predictions) == 1000: #hard coded
+        # two dots and two norms; pearsonr would also compute a p-value that the
+        # caller throws away
+        xm = predictions - predictions.mean()
+        ym = label_ids - label_ids.mean()
+        return {"pearson": float((xm @ ym) / (np.linalg.norm(xm) * np.linalg.norm(ym) + 1e-12))}
+    elif len(predictions) % 1000 == 0:
+        # compute all per-pair correlations at once: row-normalize the 1000-example
+        # blocks and reduce with one einsum instead of a Python loop over pearsonr
+        a = predictions.reshape(-1, 1000)
+        b = label_ids.reshape(-1, 1000)
+        sa = a.std(axis=1, keepdims=True)
+        sb = b.std(axis=1, keepdims=True)
+        # constant blocks (e.g. a collapsed model) have no defined correlation;
+        # drop them instead of letting NaNs poison the mean
+        valid = ((sa != 0) & (sb != 0)).reshape(-1)
+        a = (a[valid] - a[valid].mean(axis=1, keepdims=True)) / sa[valid]
+        b = (b[valid] - b[valid].mean(axis=1, keepdims=True)) / sb[valid]
+        return {"pearson": np.einsum("ij,ij->i", a, b).mean() / 1000}
     else:
-        predictions = p.predictions.reshape(-1)
         all_r = []
         for i in range(0, len(predictions), 1000):
-            all_r.append(pearsonr(predictions[i:i+1000], p.label_ids[i:i+1000])[0])
+            pred, lab = predictions[i:i+1000], label_ids[i:i+1000]
+            if pred.std() == 0 or lab.std() == 0:
+                continue
+            all_r.append(pearsonr(pred, lab)[0])
         return {"pearson": np.mean(all_r)}
 
 
@@ -648,13 +881,37 @@ def test_ensemble(config):
     output_dir = os.path.join(config["output_dir"], task_folder)
     os.makedirs(output_dir, exist_ok=True)
     logging.info(f"Saving results in {output_dir}")
-    yaml.dump(config, open(os.path.join(output_dir, "test_config.yaml"), "w"))
+    with open(os.path.join(output_dir, "test_config.yaml"), "w") as f:
+        yaml.dump(config, f)
     results = {"dev": [], "test": [], "task": task}
+    # one EnsembleTrainer reused for every pair and split; only the adapter setup
+    # changes between pairs, so re-instantiating the Trainer was pure overhead
+    eval_args = TrainingArguments(output_dir=output_dir,
+                                  remove_unused_columns=False,
+                                  per_device_eval_batch_size=config["test"]["batchsize"],
+                                  run_name=task_folder,
+                                  report_to=config.get("report_to", "all"),
+                                  skip_memory_metrics=config.get("skip_memory_metrics", True),
+                                  dataloader_num_workers=config.get("num_workers", 4),
+                                  dataloader_pin_memory=True,
+                                  **full_eval_precision(config))
+    if (config.get("torch_compile", True) and hasattr(torch, "compile")
+            and not isinstance(model, torch._dynamo.OptimizedModule)):
+        model = torch.compile(model, mode="reduce-overhead", fullgraph=False)
+    eval_trainer = EnsembleTrainer(
+        model=model,
+        args=eval_args,
+        compute_metrics=compute_pearson,
+        data_collator=dynamic_collator(config)
+    )
+    # load the union of pair languages up front; load_lang_adapter is idempotent,
+    # so pairs sharing a language reuse what is already on the model
+    for pair in config["test"]["pairs"]:
+        load_lang_adapter(model, pair[0], config)
+        load_lang_adapter(model, pair[1], config)
     for pair in config["test"]["pairs"]:
         lang1, lang2 = pair
         logging.info(f"Evaluation results for {task} {lang1}-{lang2}")
-        load_lang_adapter(model, lang1, config)
-        load_lang_adapter(model, lang2, config)
         dataset = load_data(pair, task, config)
 
         skip_layer = [] # [11] if config.get("madx2", False) else []
@@ -663,53 +920,49 @@ def test_ensemble(config):
         else:
             setup = [[ac.Split(lang1, lang2, split_index=config.get("max_seq_len", 50)), a] for a in all_task_adapters]
         #model.set_active_adapters(setup, skip_layers=skip_layer)
-        dev_trainer = EnsembleTrainer(
-            model=model,
-            args=TrainingArguments(output_dir=output_dir,
-                                   remove_unused_columns=False,
-                                   per_device_eval_batch_size=config["test"]["batchsize"],
-                                   run_name=task_folder,
-                                   report_to=config.get("report_to", "all"),
-                                   skip_memory_metrics=config.get("skip_memory_metrics", True)),
-            eval_dataset=dataset["dev"],
-            compute_metrics=compute_pearson,
-            adapter_setup=setup
-        )
-        dev_evaluation = dev_trainer.evaluate(metric_key_prefix="dev")
+        eval_trainer.adapter_setup = setup
+        dev_evaluation = eval_trainer.evaluate(eval_dataset=dataset["dev"], metric_key_prefix="dev")
         dev_evaluation["pair"] = f"{lang1}_{lang2}"
         results["dev"].append(dev_evaluation)
-        test_trainer = EnsembleTrainer(
-            model=model,
-            args=TrainingArguments(output_dir=output_dir,
-                                   remove_unused_columns=False,
-                                   per_device_eval_batch_size=config["test"]["batchsize"],
-                                   run_name=task_folder,
-                                   report_to=config.get("report_to", "all"),
-                                   skip_memory_metrics=config.get("skip_memory_metrics", True)),
-            eval_dataset=dataset["test"],
-            compute_metrics=compute_pearson,
-            adapter_setup=setup
-        )
-        test_evaluation = test_trainer.evaluate(metric_key_prefix="test")
+        test_evaluation = eval_trainer.evaluate(eval_dataset=dataset["test"], metric_key_prefix="test")
         test_evaluation["pair"] = f"{lang1}_{lang2}"
         results["test"].append(test_evaluation)
     logging.info(results)
-    json.dump(results, open(os.path.join(output_dir, f"evaluation_{task}.json"), "w"), indent=2)
+    with open(os.path.join(output_dir, f"evaluation_{task}.json"), "w") as f:
+        json.dump(results, f, indent=2)
+
+
+def widen_index_inputs(inputs):
+    # with int32_ids storage the index tensors arrive narrow; widen them after
+    # the device transfer, where the upcast is free compared to the PCIe cost
+    # (and required below torch 1.10, where F.embedding only takes int64)
+    for name in ("input_ids", "token_type_ids"):
+        if name in inputs and inputs[name].dtype != torch.long:
+            inputs[name] = inputs[name].long()
+    return inputs
 
 
 class CustomTrainer(Trainer):
+    def _prepare_inputs(self, inputs):
+        return widen_index_inputs(super()._prepare_inputs(inputs))
+
     def get_train_dataloader(self):
         if self.train_dataset is None:
             raise ValueError("Trainer: training requires a train_dataset.")
         train_sampler = MultiSampler(self.train_dataset, self.args.train_batch_size)
+        num_workers = self.args.dataloader_num_workers
         return DataLoader(
             self.train_dataset,
             batch_size=self.args.train_batch_size,
             sampler=train_sampler,
             collate_fn=self.data_collator,
             drop_last=self.args.dataloader_drop_last,
-            num_workers=self.args.dataloader_num_workers,
+            num_workers=num_workers,
             pin_memory=self.args.dataloader_pin_memory,
+            persistent_workers=num_workers > 0,
+            # prefetch_factor may only be specified with worker processes (torch
+            # >= 2.0 rejects it outright for num_workers=0), so omit it otherwise
+            **({"prefetch_factor": 4} if num_workers > 0 else {}),
         )
 
     def prediction_loop(
@@ -748,9 +1001,6 @@ class CustomTrainer(Trainer):
         logging.info(f"***** Running {description} *****")
         logging.info(f"  Num examples = {num_examples}")
         logging.info(f"  Batch size = {batch_size}")
-        losses_host: torch.Tensor = None
-        preds_host: Union[torch.Tensor, List[torch.Tensor]] = None
-        labels_host: Union[torch.Tensor, List[torch.Tensor]] = None
 
         world_size = max(1, self.args.world_size)
 
@@ -771,39 +1021,57 @@ class CustomTrainer(Trainer):
 
         self.callback_handler.eval_dataloader = dataloader
 
+        # Accumulate per-step tensors in lists and concatenate once per flush: the old
+        # nested_concat-per-step pattern re-copied the whole growing host tensor every
+        # step, making eval O(N^2) in bytes moved.
+        losses_list, preds_list, labels_list = [], [], []
+        flush_every = self.args.eval_accumulation_steps or 32
+
+        def flush():
+            if losses_list:
+                eval_losses_gatherer.add_arrays(self._gather_and_numpify(torch.cat(losses_list, dim=0), "eval_losses"))
+                losses_list.clear()
+            if not prediction_loss_only:
+                if preds_list:
+                    preds_gatherer.add_arrays(self._gather_and_numpify(torch.cat(preds_list, dim=0), "eval_preds"))
+                    preds_list.clear()
+                if labels_list:
+                    labels_gatherer.add_arrays(self._gather_and_numpify(torch.cat(labels_list, dim=0), "eval_label_ids"))
+                    labels_list.clear()
+
+        ### THIS IS A DIRTY HACK
+        # look the adapter-switching callback up by type instead of trusting it to
+        # be the last one registered, and switch on true sample counts so batch
+        # sizes that do not divide 1000 still line up with the per-pair eval blocks
+        lang_callback = next((cb for cb in self.callback_handler.callbacks
+                              if isinstance(cb, AdapterLangCallback)), None)
+        samples_seen = 0
+        next_switch = 0
         for step, inputs in enumerate(dataloader):
-            ### THIS IS A DIRTY HACK
-            if (step * batch_size)%1000 == 0:
-                self.callback_handler.callbacks[-1].next_test_adapter(model)
+            if lang_callback is not None and samples_seen >= next_switch:
+                lang_callback.next_test_adapter(model)
+                next_switch += 1000
+            samples_seen += next(iter(inputs.values())).shape[0]
             loss, logits, labels = self.prediction_step(model, inputs, prediction_loss_only, ignore_keys=ignore_keys)
             if loss is not None:
-                losses = loss.repeat(batch_size)
-                losses_host = losses if losses_host is None else torch.cat((losses_host, losses), dim=0)
+                # stride-0 view; torch.cat materializes it only at flush time
+                losses_list.append(loss.expand(batch_size))
             if logits is not None:
-                preds_host = logits if preds_host is None else nested_concat(preds_host, logits, padding_index=-100)
+                preds_list.append(logits)
             if labels is not None:
-                labels_host = labels if labels_host is None else nested_concat(labels_host, labels, padding_index=-100)
+                labels_list.append(labels)
             self.control = self.callback_handler.on_prediction_step(self.args, self.state, self.control)
 
             # Gather all tensors and put them back on the CPU if we have done enough accumulation steps.
-            if self.args.eval_accumulation_steps is not None and (step + 1) % self.args.eval_accumulation_steps == 0:
-                eval_losses_gatherer.add_arrays(self._gather_and_numpify(losses_host, "eval_losses"))
-                if not prediction_loss_only:
-                    preds_gatherer.add_arrays(self._gather_and_numpify(preds_host, "eval_preds"))
-                    labels_gatherer.add_arrays(self._gather_and_numpify(labels_host, "eval_label_ids"))
-
-                # Set back to None to begin a new accumulation
-                losses_host, preds_host, labels_host = None, None, None
+            if (step + 1) % flush_every == 0:
+                flush()
 
         if self.args.past_index and hasattr(self, "_past"):
             # Clean the state at the end of the evaluation loop
             delattr(self, "_past")
 
         # Gather all remaining tensors and put them back on the CPU
-        eval_losses_gatherer.add_arrays(self._gather_and_numpify(losses_host, "eval_losses"))
-        if not prediction_loss_only:
-            preds_gatherer.add_arrays(self._gather_and_numpify(preds_host, "eval_preds"))
-            labels_gatherer.add_arrays(self._gather_and_numpify(labels_host, "eval_label_ids"))
+        flush()
 
         eval_loss = eval_losses_gatherer.finalize()
         preds = preds_gatherer.finalize() if not prediction_loss_only else None
@@ -834,6 +1102,9 @@ class EnsembleTrainer(Trainer):
         self.adapter_setup = adapter_setup
         self.weird_fix = weird_fix
 
+    def _prepare_inputs(self, inputs):
+        return widen_index_inputs(super()._prepare_inputs(inputs))
+
     def prediction_loop(
             self,
             dataloader: DataLoader,
@@ -871,9 +1142,33 @@ class EnsembleTrainer(Trainer):
         logging.info(f"***** Running {description} *****")
         logging.info(f"  Num examples = {num_examples}")
         logging.info(f"  Batch size = {batch_size}")
-        losses_host: torch.Tensor = None
-        preds_host: Union[torch.Tensor, List[torch.Tensor]] = None
-        labels_host: Union[torch.Tensor, List[torch.Tensor]] = None
+        # the eval set size is known, so accumulate into preallocated host buffers
+        # written with slice copies; concatenating per step re-copied the whole
+        # growing tensor every batch, and pinning keeps the copies DMA-able
+        n_setup = len(self.adapter_setup)
+        steps_per_setup = len(dataloader)
+        pin = torch.cuda.is_available()
+        losses_buf = preds_buf = labels_buf = None
+        losses_idx = example_idx = 0
+        copy_stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+        # one stream per adapter setup: the adapter routing is resolved while Python
+        # launches each forward, so the small per-setup forwards can overlap on the
+        # SMs instead of running strictly back to back
+        setup_streams = None
+        if torch.cuda.is_available() and n_setup > 1:
+            setup_streams = [torch.cuda.Stream() for _ in range(n_setup)]
+
+        def host_copy(dst, src):
+            # stage device-to-host copies on a side stream so the next forward is
+            # not stalled behind the PCIe transfer; the final synchronize below
+            # fences everything before the buffers are read
+            if copy_stream is not None:
+                copy_stream.wait_stream(torch.cuda.current_stream())
+                with torch.cuda.stream(copy_stream):
+                    dst.copy_(src, non_blocking=True)
+                src.record_stream(copy_stream)
+            else:
+                dst.copy_(src, non_blocking=True)
 
         world_size = max(1, self.args.world_size)
 
@@ -894,40 +1189,73 @@ class EnsembleTrainer(Trainer):
 
         self.callback_handler.eval_dataloader = dataloader
 
-        for setup in self.adapter_setup:
-            model.set_active_adapters(setup)
-            for step, inputs in enumerate(dataloader):
-                loss, logits, labels = self.prediction_step(model, inputs, prediction_loss_only, ignore_keys=ignore_keys)
-                if loss is not None:
-                    losses = loss.repeat(batch_size)
-                    losses_host = losses if losses_host is None else torch.cat((losses_host, losses), dim=0)
-                if logits is not None:
-                    preds_host = logits if preds_host is None else nested_concat(preds_host, logits, padding_index=-100)
-                if labels is not None:
-                    labels_host = labels if labels_host is None else nested_concat(labels_host, labels, padding_index=-100)
-                self.control = self.callback_handler.on_prediction_step(self.args, self.state, self.control)
-
-                # Gather all tensors and put them back on the CPU if we have done enough accumulation steps.
-                if self.args.eval_accumulation_steps is not None and (step + 1) % self.args.eval_accumulation_steps == 0:
-                    eval_losses_gatherer.add_arrays(self._gather_and_numpify(losses_host, "eval_losses"))
+        for step, inputs in enumerate(dataloader):
+            # move each batch to the device once and run every adapter setup on it;
+            # the old setup-major order replayed the dataloader and the
+            # host-to-device transfer once per setup
+            inputs = self._prepare_inputs(inputs)
+            batch_rows = 0
+            for setup_i, setup in enumerate(self.adapter_setup):
+                if setup_streams is not None:
+                    stream = setup_streams[setup_i]
+                    stream.wait_stream(torch.cuda.current_stream())
+                    stream_ctx = torch.cuda.stream(stream)
+                else:
+                    stream_ctx = contextlib.nullcontext()
+                with stream_ctx:
+                    model.set_active_adapters(setup)
+                    loss, logits, labels = self.prediction_step(model, inputs, prediction_loss_only, ignore_keys=ignore_keys)
+                    # the buffer writes stay on the setup's stream so they order
+                    # after its forward without synchronizing the other setups
+                    if loss is not None:
+                        if losses_buf is None:
+                            losses_buf = torch.empty(n_setup * steps_per_setup * batch_size,
+                                                     dtype=loss.dtype, pin_memory=pin)
+                        # keep the setup-major layout the final reshape expects;
+                        # expand is a stride-0 view, so the repeated scalar is
+                        # never materialized on the device
+                        offset = setup_i * steps_per_setup * batch_size + step * batch_size
+                        host_copy(losses_buf[offset:offset + batch_size], loss.expand(batch_size))
+                        losses_idx += batch_size
                     if not prediction_loss_only:
-                        preds_gatherer.add_arrays(self._gather_and_numpify(preds_host, "eval_preds"))
-                        labels_gatherer.add_arrays(self._gather_and_numpify(labels_host, "eval_label_ids"))
-
-                    # Set back to None to begin a new accumulation
-                    losses_host, preds_host, labels_host = None, None, None
+                        if logits is not None:
+                            batch_rows = logits.shape[0]
+                            if preds_buf is None:
+                                # predictions stay on the model's device so the ensemble
+                                # mean runs as one kernel there; only the reduced result
+                                # crosses to the host
+                                preds_buf = torch.empty((n_setup * num_examples,) + logits.shape[1:],
+                                                        dtype=logits.dtype, device=logits.device)
+                            offset = setup_i * num_examples + example_idx
+                            preds_buf[offset:offset + batch_rows].copy_(logits)
+                        if labels is not None and setup_i == 0:
+                            # labels are the same for every setup, store them once
+                            batch_rows = labels.shape[0]
+                            if labels_buf is None:
+                                labels_buf = torch.empty((num_examples,) + labels.shape[1:],
+                                                         dtype=labels.dtype, pin_memory=pin)
+                            host_copy(labels_buf[example_idx:example_idx + batch_rows], labels)
+            if setup_streams is not None:
+                # rejoin the setup streams before the next batch reuses the inputs
+                for stream in setup_streams:
+                    torch.cuda.current_stream().wait_stream(stream)
+            example_idx += batch_rows
+            self.control = self.callback_handler.on_prediction_step(self.args, self.state, self.control)
 
-            if self.args.past_index and hasattr(self, "_past"):
-                # Clean the state at the end of the evaluation loop
-                delattr(self, "_past")
+        if self.args.past_index and hasattr(self, "_past"):
+            # Clean the state at the end of the evaluation loop
+            delattr(self, "_past")
 
-        # Gather all remaining tensors and put them back on the CPU
+        # make sure all async device-to-host copies have landed before reducing;
+        # loss-only eval never issued any, so it skips the sync as well
+        if torch.cuda.is_available() and (losses_buf is not None or labels_buf is not None):
+            torch.cuda.synchronize()
         if not self.weird_fix:
-            eval_losses_gatherer.add_arrays(self._gather_and_numpify(losses_host.reshape(len(self.adapter_setup), -1).mean(dim=0), "eval_losses"))
+            eval_losses_gatherer.add_arrays(self._gather_and_numpify(losses_buf[:losses_idx].reshape(n_setup, -1).mean(dim=0), "eval_losses"))
         if not prediction_loss_only:
-            preds_gatherer.add_arrays(self._gather_and_numpify(preds_host.reshape(len(self.adapter_setup), -1).mean(dim=0), "eval_preds"))
+            preds_gatherer.add_arrays(self._gather_and_numpify(preds_buf.reshape(n_setup, -1).mean(dim=0), "eval_preds"))
             if not self.weird_fix:
-                labels_gatherer.add_arrays(self._gather_and_numpify(labels_host[:1000], "eval_label_ids"))
+                labels_gatherer.add_arrays(self._gather_and_numpify(labels_buf[:num_examples], "eval_label_ids"))
 
         eval_loss = eval_losses_gatherer.finalize() if not self.weird_fix else None
         preds = preds_gatherer.finalize() if not prediction_loss_only else None
@@ -997,16 +1325,12 @@ class MultiSampler(Sampler):
         self.max_get = self.batchsize*(7000//self.batchsize)
 
     def __iter__(self):
-        permutation = np.random.permutation(range(7000))
-        idx = 0
-        round = 0
-        while idx < self.max_get:
-            for i in range(self.batchsize):
-                yield permutation[idx+i].item() + round*7000
-            round += 1
-            if round == self.max_rounds:
-                idx += self.batchsize
-                round = 0
+        # precompute the full index schedule in one NumPy op instead of yielding
+        # indices one at a time through nested Python loops
+        batches = np.random.permutation(7000)[:self.max_get].reshape(-1, self.batchsize)
+        rounds = np.arange(self.max_rounds) * 7000
+        indices = (batches[:, None, :] + rounds[None, :, None]).reshape(-1)
+        return iter(indices.tolist())
 
     def __len__(self) -> int:
         return self.max_rounds * self.max_get
@@ -1035,5 +1359,6 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("config")
     args = parser.parse_args()
-    config = yaml.load(open(args.config), Loader=yaml.FullLoader)
+    with open(args.config) as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
     main(config)
\ No newline at end of file
@@ -17,7 +17,8 @@ for pair in files:
     lang1, lang2 = pair.split('-')
     da_scores = pd.read_csv(f"../data/data/direct-assessments/test/{lang1}-{lang2}/test20.{lang1}{lang2}.df.short.tsv",
                                     delimiter="\t", quoting=3)['z_mean']
-    true_scores.append(da_scores)
+    # keep the raw ndarray; everything downstream is numpy math
+    true_scores.append(da_scores.to_numpy())
 
 
 def combine(xm_scores, reg_scores, alpha):
@@ -29,16 +30,9 @@ def load_submission_file():
     submission_file = os.path.isfile(os.path.join('..', 'results', 'qe-da', 'predictions_xlmr_multi_all_.txt'))
     submission_file = 'predictions_xlmr_multi_all_.txt'
     submission_file = 'message.txt'
-    temp = open(submission_file, 'r', encoding='utf-8').read().splitlines()[2:]
-    lines = [t.split('\t') for t in temp]
-    data = {}
-    for pair in files:
-        pair_data = []
-        for line in lines:
-            if line[0] == pair:
-                pair_data.append(float(line[3]))
-        data[pair] = pair_data
-    return data
+    # one C-level parse instead of re-scanning every line once per pair
+    df = pd.read_csv(submission_file, sep='\t', header=None, skiprows=2, quoting=3)
+    return {pair: df.loc[df[0] == pair, 3].to_numpy() for pair in files}
 
 def load_scores():
     all_xm_scores = []
@@ -63,27 +57,30 @@ def load_scores():
     return all_xm_scores, all_reg_scores
 
 
+def row_pearson(a, b):
+    # correlation per row in one vectorized pass instead of pearsonr per pair
+    am = a - a.mean(axis=1, keepdims=True)
+    bm = b - b.mean(axis=1, keepdims=True)
+    return np.einsum("ij,ij->i", am, bm) / (np.linalg.norm(am, axis=1) * np.linalg.norm(bm, axis=1))
+
+
 def main(alphas):
     xm_scores, reg_scores = load_scores()
-    #regression_pearson = []
-    #for i in range(len(reg_scores)):
-    #    reg = reg_scores[i]
-    #    gt = true_scores[i]
-    #    pearson = pearsonr(reg, gt)
     lp = ['en-de', 'en-zh', 'ru-en', 'ro-en']
 
-    reg_pearsons = [pearsonr(reg, gt.tolist())[0] for reg, gt in zip(reg_scores, true_scores)]
+    # stack the scores once; each alpha is then a weighted add plus one row
+    # correlation over all pairs
+    X = np.stack([np.asarray(x) for x in xm_scores])
+    R = np.stack([np.asarray(r) for r in reg_scores])
+    T = np.stack(true_scores)
+
+    reg_pearsons = row_pearson(R, T)
     for alpha in alphas:
-        i = 0
         print('---------------- alpha: {} ----------------'.format(alpha))
-        for xms, reg in zip(xm_scores, reg_scores):
-            reg_corr = reg_pearsons[i]
-            combined_scores = combine(xms, reg, alpha)
-            combined_corr = pearsonr(combined_scores, true_scores[i])[0]
-
+        combined_corrs = row_pearson(alpha * X + (1 - alpha) * R, T)
+        for i, (reg_corr, combined_corr) in enumerate(zip(reg_pearsons, combined_corrs)):
             if reg_corr < combined_corr or True:
                 print("Regression corr: {}, Combined corr: {} ({})".format(reg_corr, combined_corr, lp[i]))
-            i += 1
 
 alphas = [0.1, 0.25, 0.5]
 
@@ -1,5 +1,30 @@
 import json
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
+
+def load_test_results(path):
+    # only the "test" rows are ever read, so stream them out instead of building
+    # the whole document; without ijson, decode with orjson if available, which
+    # is several times faster than the stdlib on these files
+    with open(path, "rb") as fp:
+        if ijson is not None:
+            return list(ijson.items(fp, "test.item"))
+        return _loads(fp.read())["test"]
 
 
 ordering = {
@@ -11,34 +36,76 @@ ordering = {
     "en_zh": 5,
     "ru_en": 6
 }
+# bound once so the per-folder comprehension iterates a tuple, not a dict view
+pair_keys = tuple(ordering)
+
+def load_test_pearsons(folder, cache):
+    # result files are written once by the training run and never change, so
+    # memoize the extracted row keyed by mtime in a sidecar cache at root
+    path = os.path.join(folder, "evaluation_qe_da.json")
+    key = f"{folder}:{os.stat(path).st_mtime_ns}"
+    if key in cache:
+        return cache[key]
+    res = load_test_results(path)
+    # one comprehension over the 7 ordered keys instead of a dict lookup per row
+    by_pair = {r["pair"]: r["test_pearson"] for r in res}
+    # ijson yields Decimal for the scores; coerce so the cache stays serializable
+    cache[key] = [float(by_pair.get(k, 0)) for k in pair_keys]
+    return cache[key]
+
 
 def parse(root, folders):
-    devs = []
-    tests = []
-    for f in folders:
-        folder = os.path.join(root, f)
-        res = json.load(open(os.path.join(folder, "evaluation_qe_da.json")))
-
-        # dev_res = [0]*len(ordering)
-        # for r in res["dev"]:
-        #     dev_res[ordering[r["pair"]]] = r["dev_pearson"]
-        # devs.append(",".join([f"{p:.4f}" for p in dev_res]))
-
-        test_res = [0]*len(ordering)
-        for r in res["test"]:
-            test_res[ordering[r["pair"]]] = r["test_pearson"]
-        tests.append(",".join([f"{p:.4f}" for p in test_res]))
-
-    print("\n".join(folders))
+    # folders are os.DirEntry objects: .path comes pre-joined and scandir avoids
+    # the extra stat per entry that listdir + os.path.join incurred
+    cache_file = os.path.join(root, ".parse_cache.json")
+    cache = {}
+    if os.path.isfile(cache_file):
+        with open(cache_file) as fp:
+            cache = json.load(fp)
+
+    # fill one (folders, pairs) matrix and format it in a single pass afterwards
+    # instead of building a string per folder inside the loop
+    M = np.zeros((len(folders), len(ordering)), dtype=np.float32)
+    # dev_res = [0]*len(ordering)
+    # for r in res["dev"]:
+    #     dev_res[ordering[r["pair"]]] = r["dev_pearson"]
+    # devs.append(",".join([f"{p:.4f}" for p in dev_res]))
+
+    # each load is independent open+parse, so overlap the reads across folders;
+    # ex.map preserves input order
+    with ThreadPoolExecutor(max_workers=min(32, max(1, len(folders)))) as ex:
+        rows = ex.map(lambda f: load_test_pearsons(f.path, cache), folders)
+    for i, row in enumerate(rows):
+        M[i] = row
+
+    with open(cache_file, "w") as fp:
+        json.dump(cache, fp)
+
+    if "--ndjson" in sys.argv:
+        # one json object per folder, flushed per line so downstream consumers
+        # can start before the parse finishes
+        for f, row in zip(folders, M):
+            line = {"folder": f.name}
+            line.update(zip(pair_keys, (round(x, 4) for x in row.tolist())))
+            sys.stdout.write(json.dumps(line) + "\n")
+            sys.stdout.flush()
+        return
+
+    print("\n".join(f.name for f in folders))
     # print("DEV")
     # print("\n".join(devs))
     print("TEST")
-    print("\n".join(tests))
+    # savetxt formats the whole matrix in one shot, no per-cell python strings
+    np.savetxt(sys.stdout, M, fmt="%.4f", delimiter=",")
 
 
 if __name__ == "__main__":
 
     root = r"E:\Programming\wmt2021-qe\results\sanity"
-    folders = list(os.listdir(root))
+    # pre-filter stray files and incomplete runs instead of crashing on them;
+    # is_dir uses the DirEntry's cached type info, so only the json probe stats
+    folders = [e for e in os.scandir(root)
+               if e.is_dir(follow_symlinks=False)
+               and os.path.isfile(os.path.join(e.path, "evaluation_qe_da.json"))]
     print(",".join(ordering.keys()))
     parse(root, folders)
\ No newline at end of file